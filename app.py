@@ -10,12 +10,19 @@ import io
 import base64
 from src.exception import CustomException
 from src.pipeline.predict_pipeline import PredictOnUserInput
+from src.pipeline.model_registry import ModelRegistry
 
 
 
 APP_TITLE = 'Birmingham Parking Availability Prediction'
 APP_SUB_TITLE = 'The below map displays the coordinates of various parking lots in Birmingham, UK. Please select a date and time to view the forecasted availability across all parking lots. Additionally, you can choose individual parking lots below the map to explore its historical and projected trends.'
 
+# Memory ceiling of the model registry (least-recently-used shards get evicted above it)
+MODEL_REGISTRY_MAX_MEMORY_MB = 512
+
+# Redraw the map while forecasting only every N steps (each redraw reloads the map iframe), always on the final step
+MAP_REDRAW_EVERY_N_STEPS = 18
+
 
 # Create initial map on Application Loading
 def create_initial_map(df_ps_lat_long):
@@ -197,13 +204,18 @@ def create_colorbar_html(colormap):
 
 
 
-# Run the prediction model and fetch forecasts for all parking lots
-def forecast(user_inp_date:str, user_inp_time:str):
-    try:
-        predict_obj = PredictOnUserInput(date_inp=user_inp_date, time_inp=user_inp_time)
-        forecast_ps_avail_dict = predict_obj.forcast_all_parkLots()
+# Model registry shared across user sessions, so loaded shards are reused between forecasts
+@st.cache_resource
+def get_model_registry():
+    return ModelRegistry(artifacts_dir='artifacts', max_memory_mb=MODEL_REGISTRY_MAX_MEMORY_MB)
+
 
-        return forecast_ps_avail_dict
+
+# Generate a dataframe with the availability information per parking lot merged with its geo-location
+def get_availability_df(df_ps_lat_long, ps_idx_list, availability_arr):
+    try:
+        df_avail_info = pd.DataFrame({'ps_idx':ps_idx_list, 'Availability':availability_arr})
+        return pd.merge(df_ps_lat_long, df_avail_info, on='ps_idx', how='inner')
     except Exception as e:
         custom_exception =  CustomException(e, sys)
         print(custom_exception)
@@ -270,8 +282,22 @@ def main():
         # print(df_lat_long.shape)
 
 
-        # Create sidebar for user input: Date and time
+        # Model registry serving the fitted models of all parking lots
+        model_registry = get_model_registry()
+
+        # Parking lots per shard (area), a forecast only loads the shard of the selected area
+        area_lots_dict = model_registry.group_by_shard(model_registry.ps_idx_list)
+
+
+        # Create sidebar for user input: Area, Date and time
         st.sidebar.header("Specify date and time for forecast")
+        if len(area_lots_dict)>1:
+            selected_area = st.sidebar.selectbox("Select Area", list(area_lots_dict.keys()))
+        else:
+            selected_area = list(area_lots_dict.keys())[0]
+        area_lots = area_lots_dict[selected_area]
+        df_area_lat_long = df_lat_long[df_lat_long['ps_idx'].isin(area_lots)]
+
         selected_date = st.sidebar.date_input("Select Date", min_value=pd.to_datetime('2016-12-13'), max_value=pd.to_datetime('2016-12-19'))
         selected_time = st.sidebar.selectbox("Select Time", ["08:00", "08:30", "09:00", "09:30", "10:00", "10:30", 
                                                             "11:00", "11:30", "12:00", "12:30", "13:00", "13:30", 
@@ -289,50 +315,70 @@ def main():
         # colormap = cm.linear.Spectral_11.scale(0, 100).to_step(100)
 
 
-        forecasted_dict = {}
+        # Create colorbar HTML
+        colorbar_html = create_colorbar_html(colormap)
+        # Embed colorbar
+        st.components.v1.html(colorbar_html, height=50,)
+
+
         # Forecast on Predict Button Click Event:
         if predict_clicked:
 
-            # Get forecasted time series
-            forecasted_dict = forecast(user_inp_date=str(selected_date), user_inp_time=str(selected_time))
+            predict_obj = PredictOnUserInput(date_inp=str(selected_date), time_inp=str(selected_time), 
+                                             registry=model_registry, ps_idx_list=area_lots)
+            predict_obj.load_artifacts()
+            forecast_nsteps = predict_obj.get_forecast_steps()
 
-            # Retrieve the latest data point
-            latest_availability = {'ps_idx':[], 'Availability':[]}
-            for ps_idx in list(forecasted_dict.keys()):
+            progress_bar = st.progress(0, text='Forecasting...')
+            map_placeholder = st.empty()
 
-                availability_at_user_dt = forecasted_dict[ps_idx]['forecast'].iloc[-1]
-                latest_availability['ps_idx'].append(ps_idx)
-                latest_availability['Availability'].append(availability_at_user_dt)
+            # Update the map progressively as each forecast step finishes
+            # (changing the date/time mid-computation makes Streamlit rerun the script, which stops this loop)
+            forecast_ts_list = []
+            forecast_occu_list = []
+            for step, sample_ts, occupancy_arr, availability_arr in predict_obj.stream_forecast_all_parkLots():
 
-            # Generating a dataframe with the availability information at user inputted datetime
-            df_latest_avail_info = pd.DataFrame(latest_availability)
+                forecast_ts_list.append(sample_ts)
+                forecast_occu_list.append(occupancy_arr)
 
-            df_latest_avail_info_merged = pd.merge(df_lat_long, df_latest_avail_info, on='ps_idx', how='inner')
+                progress_bar.progress((step+1)/forecast_nsteps, text=f'Forecasted availability up to {sample_ts}')
 
-            # # DEBUG
-            # print(selected_date, selected_time)
-            # print(df_latest_avail_info_merged.shape)
-            # print(df_latest_avail_info_merged)
-            # print('-'*50)
+                if (step+1)%MAP_REDRAW_EVERY_N_STEPS!=0 and step+1!=forecast_nsteps:
+                    continue
 
-            # Generate map post prediction
-            st.session_state['map'] = create_post_prediction_map(df_ps_lat_long_avail=df_latest_avail_info_merged, 
-                                                                colormap_inp=colormap)
-            
-            st.session_state['historical_forecast_dict'] = forecasted_dict
+                df_avail_info_merged = get_availability_df(df_ps_lat_long=df_area_lat_long, 
+                                                           ps_idx_list=predict_obj.ps_idx_list, 
+                                                           availability_arr=availability_arr)
+                
+                # # DEBUG
+                # print(step, sample_ts)
+                # print(df_avail_info_merged.shape)
+                # print('-'*50)
 
+                step_map = create_post_prediction_map(df_ps_lat_long_avail=df_avail_info_merged, colormap_inp=colormap)
+                with map_placeholder.container():
+                    st.components.v1.html(step_map._repr_html_(), width=800, height=600)
 
+            progress_bar.empty()
+            map_placeholder.empty()
 
 
-        # Create colorbar HTML
-        colorbar_html = create_colorbar_html(colormap)
-        # Embed colorbar
-        st.components.v1.html(colorbar_html, height=50,)
+            # Keep the results only if the forecast ran up to the user inputted datetime
+            if len(forecast_ts_list)==forecast_nsteps:
+
+                # Generate map post prediction (availability at user inputted datetime)
+                st.session_state['map'] = step_map
+                st.session_state['forecast_area'] = selected_area
+                st.session_state['historical_forecast_dict'] = predict_obj.build_forecast_dict(forecast_ts_list, 
+                                                                                                forecast_occu_list)
+
 
 
         # Show Initial Map on Web-App Loading and updated map post forecasting
-        if 'map' not in st.session_state:
-            map_ = create_initial_map(df_ps_lat_long=df_lat_long)
+        # (the forecast is shown only for the area it was made for)
+        forecast_shown = st.session_state.get('forecast_area')==selected_area
+        if not forecast_shown:
+            map_ = create_initial_map(df_ps_lat_long=df_area_lat_long)
         else:
             map_ = st.session_state['map']
 
@@ -343,11 +389,11 @@ def main():
 
 
         # View Historical and Projected Trends across parking lots
-        selected_park_lot_id = st.slider('Select Parking Lot ID:', min_value=1, max_value=27, value=1)
+        selected_park_lot_id = st.select_slider('Select Parking Lot ID:', options=area_lots)
 
 
         # Show Trend post prediction
-        if 'historical_forecast_dict' in st.session_state:
+        if forecast_shown:
             
             prediction_dict = st.session_state['historical_forecast_dict']
             historical_trend = np.round(100-prediction_dict[selected_park_lot_id]['train'].iloc[-126:], 2)
@@ -355,6 +401,11 @@ def main():
             generate_plot(historical_data=historical_trend, forecasted_data=forecsted_trend, ps_idx=selected_park_lot_id)
 
 
+        # Model registry statistics
+        with st.sidebar.expander("Model registry stats"):
+            st.json(model_registry.get_metrics())
+
+
     except Exception as e:
         custom_exception =  CustomException(e, sys)
         print(custom_exception)
@@ -0,0 +1,361 @@
+import sys
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from src.exception import CustomException
+from src.utils import load_object, save_object
+
+
+# Every shard directory holds the same three artifacts as the main artifacts directory, restricted to its own lots
+DATA_FILE_NAME = 'reg_v1_train_test_dict.pkl'
+SCALER_FILE_NAME = 'fit_std_scaler_dict.pkl'
+MODEL_FILE_NAME = 'fit_models_best_dict.pkl'
+
+SHARDS_DIR_NAME = 'shards'
+SHARD_INDEX_FILE_NAME = 'shard_index.pkl'
+
+# Shard used when the artifacts directory has not been sharded (the three monolithic pickles)
+DEFAULT_SHARD_ID = 'default'
+
+
+
+class ModelRegistry:
+    '''
+    Serves the time series data, fitted standard_scaler and fitted XGBoost model of each ParkLot (ps_idx).
+    Artifacts are partitioned into shards (by city or lot range, see build_shards), a shard is loaded only when
+    one of its lots is requested, and least-recently-used shards are evicted to stay under max_memory_mb.
+    Shards pinned by a running forecast (get_lots_artifacts(pin=True) until release_shards) are never evicted.
+    The memory of a shard is estimated from the size of its pickles on disk.
+    '''
+
+    def __init__(self, artifacts_dir:str='artifacts', max_memory_mb=None):
+
+        self.artifacts_dir = artifacts_dir
+        self.max_memory_bytes = None if max_memory_mb is None else max_memory_mb*1024*1024
+
+        self.shard_index = None
+        self.shard_cache = OrderedDict()
+        self.shard_size_dict = {}
+        self.used_memory_bytes = 0
+
+        # {shard_id: number of running forecasts using the shard}
+        self.pin_count_dict = {}
+
+        # hits/misses count shard accesses, loads counts shards successfully read from disk
+        self.metrics = {'hits':0, 'misses':0, 'loads':0, 'evictions':0}
+
+        # The registry may be shared across threads (e.g. Streamlit sessions)
+        self.lock = threading.RLock()
+
+
+
+    def get_shard_dir(self, shard_id):
+
+        if shard_id==DEFAULT_SHARD_ID:
+            return self.artifacts_dir
+        return os.path.join(self.artifacts_dir, SHARDS_DIR_NAME, str(shard_id))
+
+
+
+    def get_shard_index(self):
+
+        try:
+
+            if self.shard_index is None:
+
+                shard_index_path = os.path.join(self.artifacts_dir, SHARDS_DIR_NAME, SHARD_INDEX_FILE_NAME)
+
+                if os.path.exists(shard_index_path):
+                    # Loading {ps_idx: shard_id}
+                    self.shard_index = load_object(file_path=shard_index_path)
+                else:
+                    # Not sharded: all ParkLots live in the default shard
+                    self.shard_index = {ps_idx:DEFAULT_SHARD_ID for ps_idx in self.get_shard(DEFAULT_SHARD_ID)['data'].keys()}
+
+            return self.shard_index
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    @property
+    def ps_idx_list(self):
+        return sorted(self.get_shard_index().keys())
+
+
+
+    def group_by_shard(self, ps_idx_list):
+        '''
+        Groups the ParkLots by shard, so that callers can go through one shard at a time
+        '''
+
+        try:
+
+            shard_index = self.get_shard_index()
+
+            shard_lots_dict = OrderedDict()
+            for ps_idx in ps_idx_list:
+                shard_lots_dict.setdefault(shard_index[ps_idx], []).append(ps_idx)
+
+            return shard_lots_dict
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def get_shard(self, shard_id):
+
+        try:
+
+            with self.lock:
+
+                # Cache hit: mark the shard as most recently used
+                if shard_id in self.shard_cache:
+                    self.metrics['hits'] += 1
+                    self.shard_cache.move_to_end(shard_id)
+                    return self.shard_cache[shard_id]
+
+                self.metrics['misses'] += 1
+
+                # Loading time series data, fitted standard_scaler, fitted XGBoost models of the shard
+                shard_dir = self.get_shard_dir(shard_id)
+                file_path_list = [os.path.join(shard_dir, file_name) for file_name in [DATA_FILE_NAME, SCALER_FILE_NAME, MODEL_FILE_NAME]]
+                shard_size = sum([os.path.getsize(file_path) for file_path in file_path_list])
+
+                shard = {'data':load_object(file_path=file_path_list[0]),
+                         'scaler':load_object(file_path=file_path_list[1]),
+                         'model':load_object(file_path=file_path_list[2])}
+
+                # load_object returns None on failure: never cache (or count memory for) a partially loaded shard
+                failed_list = [key for key, obj in shard.items() if obj is None]
+                if failed_list:
+                    raise Exception(f'Failed to load {failed_list} of shard [{shard_id}] from [{shard_dir}]')
+
+                self.metrics['loads'] += 1
+
+                # Evict least-recently-used shards until the new shard fits (kept anyway if the rest is pinned or it is larger than the ceiling)
+                self.evict_lru_shards(extra_bytes=shard_size)
+
+                self.shard_cache[shard_id] = shard
+                self.shard_size_dict[shard_id] = shard_size
+                self.used_memory_bytes += shard_size
+
+                return shard
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def evict_lru_shards(self, extra_bytes=0):
+        '''
+        Evicts unpinned shards, least-recently-used first, until extra_bytes more fit under the memory ceiling
+        '''
+
+        with self.lock:
+
+            if self.max_memory_bytes is None:
+                return
+
+            for shard_id in [shard_id for shard_id in self.shard_cache if shard_id not in self.pin_count_dict]:
+                if self.used_memory_bytes+extra_bytes<=self.max_memory_bytes:
+                    break
+                self.evict_shard(shard_id)
+
+
+
+    def evict_shard(self, shard_id):
+
+        try:
+
+            del self.shard_cache[shard_id]
+            self.used_memory_bytes -= self.shard_size_dict.pop(shard_id)
+            self.metrics['evictions'] += 1
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def get_lot_artifacts(self, ps_idx):
+        '''
+        Returns (data, std_scaler, model) of a ParkLot, where data is its {'train':df, 'test':df} dict
+        '''
+
+        try:
+
+            shard = self.get_shard(self.get_shard_index()[ps_idx])
+            return shard['data'][ps_idx], shard['scaler'][ps_idx], shard['model'][ps_idx]
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def get_lots_artifacts(self, ps_idx_list, pin=False):
+        '''
+        Returns {ps_idx: (data, std_scaler, model)} for the given ParkLots, accessing each shard once.
+        With pin=True the shards stay loaded (and counted in memory) until release_shards is called with them.
+        '''
+
+        try:
+
+            with self.lock:
+
+                pinned_shard_list = []
+                try:
+
+                    lot_artifacts_dict = {}
+                    for shard_id, shard_lots in self.group_by_shard(ps_idx_list).items():
+
+                        shard = self.get_shard(shard_id)
+                        if shard is None:
+                            raise Exception(f'Shard [{shard_id}] could not be loaded')
+
+                        if pin:
+                            self.pin_count_dict[shard_id] = self.pin_count_dict.get(shard_id, 0) + 1
+                            pinned_shard_list.append(shard_id)
+
+                        for ps_idx in shard_lots:
+                            lot_artifacts_dict[ps_idx] = (shard['data'][ps_idx], shard['scaler'][ps_idx], shard['model'][ps_idx])
+
+                    return lot_artifacts_dict
+
+                except Exception:
+                    # Do not keep partially pinned shards
+                    self.release_shards(pinned_shard_list)
+                    raise
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def release_shards(self, shard_id_list):
+        '''
+        Unpins shards pinned by get_lots_artifacts(pin=True) and evicts down to the memory ceiling again
+        '''
+
+        try:
+
+            with self.lock:
+
+                for shard_id in shard_id_list:
+                    self.pin_count_dict[shard_id] -= 1
+                    if self.pin_count_dict[shard_id]==0:
+                        del self.pin_count_dict[shard_id]
+
+                self.evict_lru_shards()
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def get_metrics(self):
+
+        with self.lock:
+
+            n_requests = self.metrics['hits'] + self.metrics['misses']
+
+            return {'hits':self.metrics['hits'],
+                    'misses':self.metrics['misses'],
+                    'loads':self.metrics['loads'],
+                    'evictions':self.metrics['evictions'],
+                    'hit_rate':self.metrics['hits']/n_requests if n_requests else 0.0,
+                    'loaded_shards':list(self.shard_cache.keys()),
+                    'pinned_shards':list(self.pin_count_dict.keys()),
+                    'used_memory_mb':self.used_memory_bytes/(1024*1024)}
+
+
+
+def build_shards(artifacts_dir:str='artifacts', shard_size:int=10, lot_to_shard=None):
+    '''
+    Splits the monolithic artifacts into shards under <artifacts_dir>/shards/<shard_id>/ and saves the shard index.
+    Shards are either given by lot_to_shard ({ps_idx: shard_id}, e.g. the city of each ParkLot)
+    or are ranges of shard_size consecutive ParkLots.
+    Shard directories of an earlier layout are removed once the new shard index is saved.
+    '''
+
+    try:
+
+        data_dict = load_object(file_path=os.path.join(artifacts_dir, DATA_FILE_NAME))
+        scaler_dict = load_object(file_path=os.path.join(artifacts_dir, SCALER_FILE_NAME))
+        model_dict = load_object(file_path=os.path.join(artifacts_dir, MODEL_FILE_NAME))
+
+        ps_idx_list = sorted(data_dict.keys())
+
+        # Assign a shard to every ParkLot
+        if lot_to_shard is None:
+            lot_to_shard = {}
+            for start in range(0, len(ps_idx_list), shard_size):
+                range_lots = ps_idx_list[start:start+shard_size]
+                for ps_idx in range_lots:
+                    lot_to_shard[ps_idx] = f'lots_{range_lots[0]}_{range_lots[-1]}'
+
+        shard_index = {ps_idx:lot_to_shard[ps_idx] for ps_idx in ps_idx_list}
+
+        # Save the artifacts of every shard
+        registry = ModelRegistry(artifacts_dir=artifacts_dir)
+        shard_dir_list = []
+        for shard_id in set(shard_index.values()):
+
+            shard_dir = registry.get_shard_dir(shard_id)
+            shard_dir_list.append(shard_dir)
+            shard_lots = [ps_idx for ps_idx in ps_idx_list if shard_index[ps_idx]==shard_id]
+
+            save_object(file_path=os.path.join(shard_dir, DATA_FILE_NAME), obj={ps_idx:data_dict[ps_idx] for ps_idx in shard_lots})
+            save_object(file_path=os.path.join(shard_dir, SCALER_FILE_NAME), obj={ps_idx:scaler_dict[ps_idx] for ps_idx in shard_lots})
+            save_object(file_path=os.path.join(shard_dir, MODEL_FILE_NAME), obj={ps_idx:model_dict[ps_idx] for ps_idx in shard_lots})
+
+            # save_object does not raise on failure: check the written files
+            for file_name in [DATA_FILE_NAME, SCALER_FILE_NAME, MODEL_FILE_NAME]:
+                file_path = os.path.join(shard_dir, file_name)
+                if not os.path.isfile(file_path) or os.path.getsize(file_path)==0:
+                    raise Exception(f'Failed to write shard file [{file_path}]')
+
+        # Save the shard index last, so that the registry only switches to shards once they are all written
+        shard_index_path = os.path.join(artifacts_dir, SHARDS_DIR_NAME, SHARD_INDEX_FILE_NAME)
+        save_object(file_path=shard_index_path, obj=shard_index)
+        if load_object(file_path=shard_index_path)!=shard_index:
+            raise Exception(f'Failed to write shard index [{shard_index_path}]')
+
+        # Remove shard directories of an earlier layout
+        shards_dir = os.path.join(artifacts_dir, SHARDS_DIR_NAME)
+        for dir_name in os.listdir(shards_dir):
+            dir_path = os.path.join(shards_dir, dir_name)
+            if os.path.isdir(dir_path) and dir_path not in shard_dir_list:
+                shutil.rmtree(dir_path)
+
+        return shard_index
+
+    except Exception as e:
+        custom_exception =  CustomException(e, sys)
+        print(custom_exception)
+
+
+
+if __name__=='__main__':
+
+    try:
+
+        shard_index = build_shards(artifacts_dir='artifacts', shard_size=10)
+        print(shard_index)
+
+        registry = ModelRegistry(artifacts_dir='artifacts', max_memory_mb=1)
+        registry.get_lots_artifacts(registry.ps_idx_list)
+        print(registry.get_metrics())
+
+    except Exception as e:
+        custom_exception =  CustomException(e, sys)
+        print(custom_exception)
@@ -4,19 +4,28 @@ import pandas as pd
 from sklearn.preprocessing import StandardScaler
 import xgboost as xgb
 from src.exception import CustomException
-from src.utils import load_object
+from src.pipeline.model_registry import ModelRegistry
 
 
 class PredictOnUserInput:
 
-    def __init__(self, date_inp:str, time_inp:str):
+    def __init__(self, date_inp:str, time_inp:str, registry=None, ps_idx_list=None):
         
         self.datetime_inp = pd.to_datetime(date_inp + ' ' + time_inp + ':00')
         self.forecast_index_list = None
 
+        # ParkLots to forecast (all lots of the registry if not given)
+        self.ps_idx_list = [] if ps_idx_list is None else list(ps_idx_list)
+
+        # Serves time series data, fitted standard_scaler, fitted XGBoost model per ParkLot
+        self.registry = registry
+
+        # Artifacts of the ParkLots to forecast, their shards stay pinned in the registry until release_artifacts
+        self.lot_artifacts_dict = {}
+        self.pinned_shard_list = []
+
+        # Time series data ({'train':df, 'test':df}) per ParkLot, kept after the artifacts are released
         self.data_dict = {}
-        self.scaler_dict = {}
-        self.model_dict = {}
 
 
 
@@ -24,13 +33,42 @@ class PredictOnUserInput:
         
         try:
 
-            # Loading time series data, fitted standard_scaler, fitted XGBoost models
-            self.data_dict  = load_object(file_path='artifacts/reg_v1_train_test_dict.pkl')
-            self.scaler_dict  = load_object(file_path='artifacts/fit_std_scaler_dict.pkl')
-            self.model_dict = load_object(file_path='artifacts/fit_models_best_dict.pkl')
+            # Model registry over the time series data, fitted standard_scaler, fitted XGBoost models
+            if self.registry is None:
+                self.registry = ModelRegistry(artifacts_dir='artifacts')
+
+            if not self.ps_idx_list:
+                self.ps_idx_list = self.registry.ps_idx_list
+
+            # Loading the artifacts of the ParkLots to forecast once, pinning their shards for the run
+            self.release_artifacts()
+            lot_artifacts_dict = self.registry.get_lots_artifacts(self.ps_idx_list, pin=True)
+            if lot_artifacts_dict is None:
+                raise Exception(f'Failed to load the artifacts of ParkLots {self.ps_idx_list}')
+
+            self.lot_artifacts_dict = lot_artifacts_dict
+            self.pinned_shard_list = list(self.registry.group_by_shard(self.ps_idx_list).keys())
+            self.data_dict = {ps_idx:self.lot_artifacts_dict[ps_idx][0] for ps_idx in self.ps_idx_list}
 
             # Loading Forecast Index and saving in a list
-            self.forecast_index_list = self.data_dict[1]['test'].index
+            self.forecast_index_list = self.data_dict[self.ps_idx_list[0]]['test'].index
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def release_artifacts(self):
+        
+        try:
+
+            # Unpin the shards in the registry, only the time series data is kept
+            if self.pinned_shard_list:
+                self.registry.release_shards(self.pinned_shard_list)
+
+            self.lot_artifacts_dict = {}
+            self.pinned_shard_list = []
 
         except Exception as e:
             custom_exception =  CustomException(e, sys)
@@ -50,76 +88,44 @@ class PredictOnUserInput:
         
 
 
-    def forcast_single_parkLot(self, steps, df_org, std_scaler, model):
+    def get_sample_features(self, sample_ts, occu_hist):
 
         try:
 
-            df_appended = df_org.copy()
+            # Get temporal features
+            sample_year = sample_ts.year
+            sample_month = sample_ts.month
+            sample_day = sample_ts.day
+            sample_dayOfWeek = sample_ts.dayofweek
+            sample_isWeekend = 1 if sample_dayOfWeek in [5, 6] else 0
+            sample_hour = sample_ts.hour
+            sample_minute = sample_ts.minute
             
-            for step in range(0, steps):
-                # print(forecast_index_list[step])
-                
-                # Get timestamp to predict for
-                sample_ts = self.forecast_index_list[step]
-
-                # Get temporal features
-                sample_year = sample_ts.year
-                sample_month = sample_ts.month
-                sample_day = sample_ts.day
-                sample_dayOfWeek = sample_ts.dayofweek
-                sample_isWeekend = 1 if sample_dayOfWeek in [5, 6] else 0
-                sample_hour = sample_ts.hour
-                sample_minute = sample_ts.minute
-                
-                # DEBUG:
-                # print(sample_year, sample_month, sample_day, sample_dayOfWeek, sample_isWeekend, sample_hour, sample_minute)
+            # DEBUG:
+            # print(sample_year, sample_month, sample_day, sample_dayOfWeek, sample_isWeekend, sample_hour, sample_minute)
 
-                # Get lag features
-                occu_rt_lag1 = df_appended.iloc[-1].loc['Occupancy_Rate']
-                occu_rt_lag2 = df_appended.iloc[-2].loc['Occupancy_Rate']
-                occu_rt_lag3 = df_appended.iloc[-3].loc['Occupancy_Rate']
-                occu_rt_lag18 = df_appended.iloc[-18].loc['Occupancy_Rate']
-                occu_rt_lag19 = df_appended.iloc[-19].loc['Occupancy_Rate']
-                occu_rt_lag20 = df_appended.iloc[-20].loc['Occupancy_Rate']
+            # Get lag features (occu_hist holds the occupancy rates in time order, latest value last)
+            occu_rt_lag1 = occu_hist[-1]
+            occu_rt_lag2 = occu_hist[-2]
+            occu_rt_lag3 = occu_hist[-3]
+            occu_rt_lag18 = occu_hist[-18]
+            occu_rt_lag19 = occu_hist[-19]
+            occu_rt_lag20 = occu_hist[-20]
 
-                
-                # Framing the dataframe for predict sample
-                df_sample = pd.DataFrame(index=[sample_ts], data={'Year':[sample_year], 'Month':[sample_month], 'Day':[sample_day], 
-                                                                'DayOfWeek':[sample_dayOfWeek], 'isWeekend':[sample_isWeekend], 
-                                                                'Hour':[sample_hour], 'Minute':[sample_minute], 
-                                                                'lag_1':[occu_rt_lag1], 'lag_2':[occu_rt_lag2], 'lag_3':[occu_rt_lag3], 
-                                                                'lag_18':[occu_rt_lag18], 'lag_19':[occu_rt_lag19],'lag_20':[occu_rt_lag20]})
-                
-                
-                # Scaling the predict sample
-                X_sample_scl = std_scaler.transform(df_sample)
-                
-                # DEBUG:
-                # print(df_sample.shape)
-                # print(X_sample_scl.shape)
-                
-                # Get the prediction out
-                pred_sample = model.predict(X_sample_scl)
-                pred_sample = 0 if pred_sample<0 else (100 if pred_sample>100 else pred_sample) # Cap the output to 0% & 100%
-                
-                # DEBUG:
-                # print(pred_sample)
-                
-                
-                # Add the predicted output to the dataframe so that future points can be predicted
-                df_sample['Occupancy_Rate'] = pred_sample
-                
             
-                # Concatenating to the tail of the original time series 
-                df_appended = pd.concat([df_appended, df_sample], axis=0)
-                
+            # Framing the dataframe for predict sample
+            df_sample = pd.DataFrame(index=[sample_ts], data={'Year':[sample_year], 'Month':[sample_month], 'Day':[sample_day], 
+                                                            'DayOfWeek':[sample_dayOfWeek], 'isWeekend':[sample_isWeekend], 
+                                                            'Hour':[sample_hour], 'Minute':[sample_minute], 
+                                                            'lag_1':[occu_rt_lag1], 'lag_2':[occu_rt_lag2], 'lag_3':[occu_rt_lag3], 
+                                                            'lag_18':[occu_rt_lag18], 'lag_19':[occu_rt_lag19],'lag_20':[occu_rt_lag20]})
             
-            return df_appended
-
-
+            return df_sample
+        
         except Exception as e:
             custom_exception =  CustomException(e, sys)
-            print(custom_exception)    
+            print(custom_exception)
+
 
 
     def occupancy_to_availability(self, fr_dict):
@@ -142,43 +148,125 @@ class PredictOnUserInput:
 
 
 
-    def forcast_all_parkLots(self):
+    def stream_forecast_all_parkLots(self, max_steps=None, cancel_event=None):
+        '''
+        Generator which forecasts all parking lots step by step and yields after every step:
+        (step, timestamp, occupancy_arr, availability_arr)
+        The arrays hold one value per parking lot, ordered as in self.ps_idx_list.
+        Stops early after max_steps steps, or as soon as cancel_event (threading.Event) is set.
+        cancel_event is meant for callers running the generator outside Streamlit (e.g. in a worker thread);
+        in the Streamlit app the rerun triggered by a changed input already stops the running forecast.
+        The shards of the requested ParkLots stay pinned in the registry for the whole run (released when the
+        generator finishes or is closed), so forecast the ParkLots of one shard/city (ps_idx_list) to stay under
+        the registry's memory ceiling.
+        '''
         
         try:
 
-            # Load Artifacts
-            self.load_artifacts()
+            # Load Artifacts (only if not loaded yet)
+            if not self.lot_artifacts_dict:
+                self.load_artifacts()
 
             # Get Forecasting steps:
             forecast_nsteps = self.get_forecast_steps()
+            if max_steps is not None:
+                forecast_nsteps = min(forecast_nsteps, max_steps)
+
+            # Keep only the last 20 occupancy rates per ParkLot (enough for the largest lag)
+            occu_hist_dict = {}
+            for ps_idx in self.ps_idx_list:
+                occu_hist_dict[ps_idx] = list(self.data_dict[ps_idx]['train']['Occupancy_Rate'].values[-20:])
+
+
+            for step in range(0, forecast_nsteps):
+
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+
+                # Get timestamp to predict for
+                sample_ts = self.forecast_index_list[step]
+
+                occupancy_arr = np.zeros(len(self.ps_idx_list))
+                # Forecast for all ParkLots at this step
+                for i, ps_idx in enumerate(self.ps_idx_list):
+
+                    _, std_scaler, xgbr_model = self.lot_artifacts_dict[ps_idx]
+
+                    occu_hist = occu_hist_dict[ps_idx]
+                    df_sample = self.get_sample_features(sample_ts=sample_ts, occu_hist=occu_hist)
+                    
+                    # Scaling the predict sample
+                    X_sample_scl = std_scaler.transform(df_sample)
+
+                    # Get the prediction out & cap the output to 0% & 100%
+                    pred_sample = float(np.clip(xgbr_model.predict(X_sample_scl)[0], 0, 100))
+
+                    # Add the predicted output to the history so that future points can be predicted
+                    occu_hist.append(pred_sample)
+                    del occu_hist[0]
+
+                    occupancy_arr[i] = pred_sample
+
+
+                yield step, sample_ts, occupancy_arr, 100-occupancy_arr
+
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+        finally:
+            self.release_artifacts()
+
+
+
+    def forcast_all_parkLots(self, max_steps=None, cancel_event=None):
+        
+        try:
+
+            # Collect the streamed forecasts
+            forecast_ts_list = []
+            forecast_occu_list = []
+            for step, sample_ts, occupancy_arr, _ in self.stream_forecast_all_parkLots(max_steps=max_steps, 
+                                                                                       cancel_event=cancel_event):
+                forecast_ts_list.append(sample_ts)
+                forecast_occu_list.append(occupancy_arr)
 
             # # DEBUG:
-            # print('Forecast steps:', forecast_nsteps)
-            # print('Park Lot IDs:', list(self.data_dict.keys()))
+            # print('Forecast steps:', len(forecast_ts_list))
+            # print('Park Lot IDs:', self.ps_idx_list)
             # print('Forecast Index List:', self.forecast_index_list)
 
-            
+            return self.build_forecast_dict(forecast_ts_list, forecast_occu_list)
+
+
+        except Exception as e:
+            custom_exception =  CustomException(e, sys)
+            print(custom_exception)
+
+
+
+    def build_forecast_dict(self, forecast_ts_list, forecast_occu_list):
+        '''
+        Frames the streamed (timestamp, occupancy_arr) steps into the per ParkLot train/test/forecast availability dict
+        '''
+
+        try:
+
+            forecast_occu_arr = np.array(forecast_occu_list).reshape(len(forecast_ts_list), len(self.ps_idx_list))
+
             forecast_dict = {}
-            # Forecast for all ParkLots
-            for ps_idx in list(self.data_dict.keys())[:]:
-                
-                df_train_ps = self.data_dict[ps_idx]['train']
-                std_scaler = self.scaler_dict[ps_idx]
-                xgbr_model = self.model_dict[ps_idx]
-                
-                # Get forecast
-                df_forecasted = self.forcast_single_parkLot(steps=forecast_nsteps, 
-                                                            df_org=df_train_ps, 
-                                                            std_scaler=std_scaler, 
-                                                            model=xgbr_model)
-                
+            for i, ps_idx in enumerate(self.ps_idx_list):
                 
+                data = self.data_dict[ps_idx]
+
                 # Save the forecasted values
                 forecast_dict[ps_idx] = {}
-                # forecast_dict[ps_idx]['train'] = df_forecasted['Occupancy_Rate'].iloc[:-forecast_nsteps]
-                forecast_dict[ps_idx]['train'] = self.data_dict[ps_idx]['train']['Occupancy_Rate']
-                forecast_dict[ps_idx]['test'] = self.data_dict[ps_idx]['test']['Occupancy_Rate']
-                forecast_dict[ps_idx]['forecast'] = df_forecasted['Occupancy_Rate'].iloc[-forecast_nsteps:]
+                forecast_dict[ps_idx]['train'] = data['train']['Occupancy_Rate']
+                forecast_dict[ps_idx]['test'] = data['test']['Occupancy_Rate']
+                forecast_dict[ps_idx]['forecast'] = pd.Series(forecast_occu_arr[:, i], 
+                                                              index=pd.DatetimeIndex(forecast_ts_list), 
+                                                              name='Occupancy_Rate')
 
 
             # Get availability
@@ -215,6 +303,13 @@ if __name__=='__main__':
         print('-'*50)
         print('Test-FORECAST:')
         print(test_dict[1]['forecast'])
+        print('-'*50)
+
+        print('Test-STREAM (first 3 steps):')
+        stream_obj = PredictOnUserInput(date_inp='2016-12-14', time_inp='15:30')
+        for step, sample_ts, occupancy_arr, availability_arr in stream_obj.stream_forecast_all_parkLots(max_steps=3):
+            print(step, sample_ts, availability_arr[:5])
+        print(stream_obj.registry.get_metrics())
     
     except Exception as e:
         custom_exception =  CustomException(e, sys)